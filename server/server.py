@@ -1,12 +1,31 @@
 import os
+import re
+import json
+import math
+import base64
+import time
+import random
+import asyncio
+import threading
+import zlib
+import shutil
+import inspect
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple, Union, TypedDict
+from functools import partial
+from typing import Annotated, Any, Awaitable, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union, TypedDict
 
-from fastapi import FastAPI, HTTPException
+import numpy as np
+
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from sqlmodel import SQLModel, Field, create_engine, Session, select
-from sqlalchemy import Column, JSON
+from sqlalchemy import Column, JSON, and_, case, event, func, or_
 
 from pydantic import BaseModel
 
@@ -14,7 +33,7 @@ from langchain.agents import initialize_agent, Tool
 from langchain.prompts import ChatPromptTemplate
 from langchain_groq import ChatGroq
 from langchain_community.tools import TavilySearchResults
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 
@@ -32,10 +51,73 @@ from datetime import datetime, timedelta
 
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./cart_2db")
-engine = create_engine(DATABASE_URL, echo=False)
+# A request's session can be opened on the event loop and used from the
+# threadpool that runs sync endpoints, so SQLite must allow cross-thread use.
+connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(DATABASE_URL, echo=False, connect_args=connect_args)
 
-# Create all tables
-SQLModel.metadata.create_all(engine)
+
+_current_session: ContextVar[Optional[Session]] = ContextVar("current_session", default=None)
+
+
+@contextmanager
+def unit_of_work() -> Iterator[Session]:
+    """
+    Opens one session (and so one connection) that every db_session() call
+    inside the block shares. Nested units reuse the outer one.
+    """
+    current = _current_session.get()
+    if current is not None:
+        yield current
+        return
+    with Session(engine, expire_on_commit=False) as session:
+        token = _current_session.set(session)
+        try:
+            yield session
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            _current_session.reset(token)
+
+
+def end_transaction() -> None:
+    """
+    Commits the current unit of work's transaction so its pooled connection
+    is released before slow non-DB work; the next query starts a new one.
+    """
+    session = _current_session.get()
+    if session is not None:
+        session.commit()
+
+
+@contextmanager
+def db_session() -> Iterator[Session]:
+    """The current unit of work's session, or a short-lived one outside of it."""
+    current = _current_session.get()
+    if current is not None:
+        yield current
+        return
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+
+
+@contextmanager
+def count_statements() -> Iterator[List[int]]:
+    """
+    Counts SQL statements run on `engine` from any thread while active; read
+    the total from [0]. Meant for tests that pin per-endpoint query budgets.
+    """
+    counter = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter[0] += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
 
 
 
@@ -51,20 +133,28 @@ class Alternatives(SQLModel, table=True):
 class Product(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
-    price: float
+    price: float = Field(index=True)
     image: Optional[str]
-    expiry_days: int
-    green_score: int
+    expiry_days: int = Field(index=True)
+    green_score: int = Field(index=True)
     alternatives: Dict[str, Any] = Field(sa_column=Column(JSON))
 
 
 class CartItem(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    product_id: int = Field(foreign_key="product.id")
+    product_id: int = Field(foreign_key="product.id", index=True)
     quantity: int
     added_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+# Create all tables; create_all skips existing tables, so also add any
+# indexes introduced since the database was first created.
+SQLModel.metadata.create_all(engine)
+for table in SQLModel.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+
 
 
 class CartItemCreate(BaseModel):
@@ -81,22 +171,41 @@ class AgentInput(BaseModel):
     message: str
 
 
+class ListingParams(BaseModel):
+    limit: Optional[int] = Field(default=None, ge=1, le=200)
+    cursor: Optional[str] = None
+    fields: Optional[str] = None
+    sort: Literal["id", "price", "green_score", "expiry_days"] = "id"
+    order: Literal["asc", "desc"] = "asc"
+    q: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    min_green_score: Optional[int] = None
+    max_expiry_days: Optional[int] = None
+
+
+class CartLine(BaseModel):
+    id: int
+    product_id: int
+    name: str
+    quantity: int
+
+
 
 
 def add_item_to_cart(product_id: int, quantity: int = 1) -> CartItem:
-    with Session(engine) as session:
+    with db_session() as session:
         product = session.get(Product, product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
         cart_item = CartItem(product_id=product_id, quantity=quantity)
         session.add(cart_item)
         session.commit()
-        session.refresh(cart_item)
         return cart_item
 
 
 def delete_item_from_cart(item_id: int) -> None:
-    with Session(engine) as session:
+    with db_session() as session:
         item = session.get(CartItem, item_id)
         if not item:
             raise HTTPException(status_code=404, detail="Cart item not found")
@@ -105,58 +214,461 @@ def delete_item_from_cart(item_id: int) -> None:
 
 
 def update_item_quantity(item_id: int, quantity: int) -> CartItem:
-    with Session(engine) as session:
+    with db_session() as session:
         item = session.get(CartItem, item_id)
         if not item:
             raise HTTPException(status_code=404, detail="Cart item not found")
         item.quantity = quantity
         session.add(item)
         session.commit()
-        session.refresh(item)
         return item
 
 
-def describe_cart() -> List[Dict[str, Any]]:
-    with Session(engine) as session:
-        statement = select(CartItem, Product).join(Product)
-        results = session.exec(statement).all()
-        description = []
-        for cart_item, product in results:
-            description.append(
-                {
-                    "cart_item_id": cart_item.id,
-                    "product": {
-                        "id": product.id,
-                        "name": product.name,
-                        "price": product.price,
-                        "image": product.image,
-                        "expiry_date": (
-                            datetime.utcnow() + timedelta(days=product.expiry_days)
-                        ).isoformat(),
-                        "green_score": product.green_score,
-                        "alternatives": product.alternatives,
-                    },
-                    "quantity": cart_item.quantity,
-                }
-            )
-        return description
+def cart_summary(within_days: int = 3, limit: int = 5) -> Dict[str, Any]:
+    """
+    Aggregates the cart in SQL: totals, quantity-weighted green score,
+    lines expiring within `within_days` and savings from price alternatives.
+    """
+    savings = func.coalesce(Product.alternatives[("price", "savings")].as_float(), 0)
+    expiring = Product.expiry_days <= within_days
+
+    with db_session() as session:
+        lines, units, total_price, green_units, expiring_units, savings_total = session.exec(
+            select(
+                func.count(CartItem.id),
+                func.coalesce(func.sum(CartItem.quantity), 0),
+                func.coalesce(func.sum(Product.price * CartItem.quantity), 0),
+                func.coalesce(func.sum(Product.green_score * CartItem.quantity), 0),
+                func.coalesce(func.sum(case((expiring, CartItem.quantity), else_=0)), 0),
+                func.coalesce(func.sum(savings * CartItem.quantity), 0),
+            ).join(Product)
+        ).one()
+
+        soonest = session.exec(
+            select(CartItem.id, Product.name, Product.expiry_days, CartItem.quantity)
+            .join(Product)
+            .where(expiring)
+            .order_by(Product.expiry_days, CartItem.id)
+            .limit(limit)
+        ).all()
+
+    now = datetime.utcnow()
+    return {
+        "lines": lines,
+        "units": units,
+        "total_price": round(float(total_price), 2),
+        "green_score": round(green_units / units, 1) if units else None,
+        "expiring_within_days": within_days,
+        "expiring_units": expiring_units,
+        "expiring_soon": [
+            {
+                "cart_item_id": item_id,
+                "name": name,
+                "quantity": quantity,
+                "expiry_date": (now + timedelta(days=expiry_days)).isoformat(),
+            }
+            for item_id, name, expiry_days, quantity in soonest
+        ],
+        "potential_savings": round(float(savings_total), 2),
+    }
+
+
+PRODUCT_FIELDS = ["id", "name", "price", "image", "expiry_days", "green_score", "alternatives"]
+CART_PRODUCT_FIELDS = ["id", "name", "price", "image", "expiry_date", "green_score", "alternatives"]
+
+
+def parse_fields(fields: Optional[str], allowed: List[str], default: Optional[List[str]] = None) -> List[str]:
+    if not fields:
+        return list(default or allowed)
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+
+def encode_cursor(params: ListingParams, sort_value: Any, row_id: int) -> str:
+    payload = [params.sort, params.order, sort_value, row_id]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str, params: ListingParams) -> Tuple[Any, int]:
+    """Validates a cursor and checks it was issued for the same sort and order."""
+    def is_number(value: Any) -> bool:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        if isinstance(value, int):
+            return -(2**63) <= value < 2**63  # SQLite INTEGER range
+        return math.isfinite(value)
+
+    try:
+        sort, order, sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not is_number(sort_value) or not is_number(row_id) or row_id != int(row_id):
+            raise ValueError("cursor values must be finite numbers")
+        row_id = int(row_id)
+        if not is_number(row_id):
+            raise ValueError("cursor row id out of range")
+    except (ValueError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if (sort, order) != (params.sort, params.order):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cursor was issued for sort={sort}&order={order}",
+        )
+    return sort_value, row_id
+
+
+def filter_products(statement, params: ListingParams):
+    if params.q:
+        statement = statement.where(Product.name.ilike(f"%{params.q}%"))
+    if params.min_price is not None:
+        statement = statement.where(Product.price >= params.min_price)
+    if params.max_price is not None:
+        statement = statement.where(Product.price <= params.max_price)
+    if params.min_green_score is not None:
+        statement = statement.where(Product.green_score >= params.min_green_score)
+    if params.max_expiry_days is not None:
+        statement = statement.where(Product.expiry_days <= params.max_expiry_days)
+    return statement
+
+
+def keyset_page(session: Session, statement, sort_col, id_col, params: ListingParams, limit: Optional[int]):
+    """
+    Runs `statement` ordered by (sort_col, id_col), resuming strictly after
+    the cursor position. Returns (rows, next_cursor).
+    """
+    statement = statement.add_columns(sort_col.label("_sort"), id_col.label("_id"))
+    desc = params.order == "desc"
+    if params.cursor:
+        value, last_id = decode_cursor(params.cursor, params)
+        if desc:
+            statement = statement.where(or_(sort_col < value, and_(sort_col == value, id_col < last_id)))
+        else:
+            statement = statement.where(or_(sort_col > value, and_(sort_col == value, id_col > last_id)))
+    if desc:
+        statement = statement.order_by(sort_col.desc(), id_col.desc())
+    else:
+        statement = statement.order_by(sort_col, id_col)
+    if limit is not None:
+        statement = statement.limit(limit + 1)
+
+    rows = session.exec(statement).all()
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(params, rows[-1]._sort, rows[-1]._id)
+
+
+def list_products(params: ListingParams) -> Dict[str, Any]:
+    fields = parse_fields(params.fields, PRODUCT_FIELDS)
+    sort_col = getattr(Product, params.sort)
+    statement = filter_products(select(*(getattr(Product, f) for f in fields)), params)
+
+    with db_session() as session:
+        rows, next_cursor = keyset_page(session, statement, sort_col, Product.id, params, params.limit or 50)
+    return {
+        "items": [{f: row._mapping[f] for f in fields} for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def list_cart(params: ListingParams) -> Dict[str, Any]:
+    fields = parse_fields(
+        params.fields,
+        ["quantity", "added_at", *CART_PRODUCT_FIELDS],
+        default=["quantity", *CART_PRODUCT_FIELDS],
+    )
+    product_fields = [f for f in fields if f in CART_PRODUCT_FIELDS]
+    columns = [CartItem.id.label("cart_item_id")]
+    columns += [getattr(CartItem, f) for f in fields if f in ("quantity", "added_at")]
+    columns += [
+        Product.expiry_days if f == "expiry_date" else getattr(Product, f).label(f"product_{f}")
+        for f in product_fields
+    ]
+    sort_col = CartItem.id if params.sort == "id" else getattr(Product, params.sort)
+    statement = filter_products(select(*columns).join(Product), params)
+
+    with db_session() as session:
+        rows, next_cursor = keyset_page(session, statement, sort_col, CartItem.id, params, params.limit)
+
+    now = datetime.utcnow()
+    items = []
+    for row in rows:
+        m = row._mapping
+        item = {"cart_item_id": m["cart_item_id"]}
+        item.update({f: m[f] for f in fields if f in ("quantity", "added_at")})
+        if product_fields:
+            item["product"] = {
+                f: (now + timedelta(days=m["expiry_days"])).isoformat()
+                if f == "expiry_date"
+                else m[f"product_{f}"]
+                for f in product_fields
+            }
+        items.append(item)
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def find_products(query: str, limit: Optional[int] = None) -> List[Tuple[int, str]]:
+    with db_session() as session:
+        statement = (
+            select(Product.id, Product.name)
+            .where(Product.name.ilike(f"%{query}%"))
+            .order_by(Product.id)
+            .limit(limit)
+        )
+        return [(pid, name) for pid, name in session.exec(statement).all()]
+
+
+SEMANTIC_INDEX_DIR = os.getenv("SEMANTIC_INDEX_DIR", "./semantic_index")
+# Only directories named like this are ours to delete; the env var may point
+# somewhere shared.
+INDEX_DIR_PATTERN = re.compile(r"index-[0-9a-f]{32}")
+EMBED_DIM = 256
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.35"))
+STOPWORDS = {"a", "an", "and", "for", "of", "the", "to", "with", "some", "in"}
+
+
+def _features(text: str) -> List[Tuple[str, float]]:
+    features = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        features.append((word, 1.0))
+        padded = f"<{word}>"
+        features.extend((padded[i : i + 3], 0.5) for i in range(len(padded) - 2))
+    return features
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Signed feature hashing of words and character trigrams into EMBED_DIM
+    unit vectors. Purely local and deterministic; captures spelling and
+    word overlap ("mozzarella for pizza" -> "Frozen Mozzarella"), not meaning.
+    """
+    out = np.zeros((len(texts), EMBED_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for feature, weight in _features(text):
+            h = zlib.crc32(feature.encode())
+            out[row, h % EMBED_DIM] += weight if h & 0x80000000 else -weight
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.maximum(norms, 1e-12)
+
 
+class SemanticIndex:
+    """
+    Inverted-file ANN index over product embeddings. Vectors are stored on
+    disk grouped by k-means cluster and memory-mapped, so a query scores the
+    centroids, then only the `nprobe` closest clusters' contiguous slices.
+    """
 
-def find_products(query: str) -> List[Tuple[int, str]]:
-    with Session(engine) as session:
-        statement = select(Product).where(Product.name.ilike(f"%{query}%"))
-        products = session.exec(statement).all()
-        return [(p.id, p.name) for p in products]
+    def __init__(self, path: str, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: List[int], names: List[str], path: str, iterations: int = 10) -> "SemanticIndex":
+        vectors = embed_texts(names)
+        n = len(vectors)
+        nlist = max(1, int(np.sqrt(n)))
+
+        # Spherical k-means on a sample is plenty for a coarse quantizer.
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(n, size=min(n, 50_000), replace=False)] if n else vectors
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)] if n else np.zeros((1, EMBED_DIM), np.float32)
+        for _ in range(iterations if n else 0):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assign = np.concatenate(
+            [np.argmax(vectors[i : i + 65_536] @ centroids.T, axis=1) for i in range(0, n, 65_536)]
+        ) if n else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), vectors[order])
+        np.save(os.path.join(path, "ids.npy"), np.asarray(ids, dtype=np.int64)[order])
+        np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        return cls(path)
+
+    def search(self, queries: List[str], k: int = 5) -> List[List[Tuple[int, float]]]:
+        if not len(self) or not queries:
+            return [[] for _ in queries]
+        q = embed_texts(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(q @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        results = []
+        for qi, clusters in enumerate(probes):
+            rows = np.concatenate(
+                [np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters]
+            )
+            if not len(rows):
+                results.append([])
+                continue
+            scores = self.vectors[rows] @ q[qi]
+            top = min(k, len(rows))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            results.append([(int(self.ids[rows[b]]), float(scores[b])) for b in best])
+        return results
+
+
+# The catalog version is bumped after every commit that writes a Product.
+# The index remembers the version it was built from; a mismatch queues a
+# rebuild on the work queue while lookups keep using the current index.
+_catalog_version = 0
+_semantic_index: Optional[SemanticIndex] = None
+_semantic_index_version = -1
+_semantic_rebuild_pending = False
+_semantic_lock = threading.Lock()
+
+
+@event.listens_for(Product, "after_insert")
+@event.listens_for(Product, "after_update")
+@event.listens_for(Product, "after_delete")
+def _mark_catalog_changed(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info["catalog_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_catalog_version(session):
+    global _catalog_version
+    if session.info.pop("catalog_changed", False):
+        with _semantic_lock:
+            _catalog_version += 1
+        schedule_semantic_rebuild()
+
+
+def schedule_semantic_rebuild() -> bool:
+    """Queues one rebuild at a time; False if the work queue isn't running."""
+    global _semantic_rebuild_pending
+    with _semantic_lock:
+        if _semantic_rebuild_pending:
+            return True
+        _semantic_rebuild_pending = True
+    if work_queue.submit(
+        "rebuild_semantic_index",
+        partial(asyncio.to_thread, rebuild_semantic_index),
+        on_drop=_release_semantic_rebuild,
+    ):
+        return True
+    _release_semantic_rebuild()
+    return False
+
+
+def _release_semantic_rebuild() -> None:
+    # A dropped rebuild must not leave the flag set, or nothing would ever
+    # schedule another one.
+    global _semantic_rebuild_pending
+    with _semantic_lock:
+        _semantic_rebuild_pending = False
+
+
+def rebuild_semantic_index() -> SemanticIndex:
+    """
+    Embeds the catalog into a fresh directory and swaps it in. Readers keep
+    the previous index (its files stay mapped) until the swap.
+    """
+    global _semantic_index, _semantic_index_version, _semantic_rebuild_pending
+    try:
+        with _semantic_lock:
+            version = _catalog_version
+        with db_session() as session:
+            rows = session.exec(select(Product.id, Product.name)).all()
+
+        name = f"index-{uuid.uuid4().hex}"
+        index = SemanticIndex.build(
+            [r[0] for r in rows], [r[1] for r in rows], os.path.join(SEMANTIC_INDEX_DIR, name)
+        )
+        pointer = os.path.join(SEMANTIC_INDEX_DIR, "CURRENT")
+        with open(f"{pointer}.tmp", "w") as f:
+            f.write(name)
+        os.replace(f"{pointer}.tmp", pointer)
+
+        with _semantic_lock:
+            _semantic_index, _semantic_index_version = index, version
+        for entry in os.listdir(SEMANTIC_INDEX_DIR):
+            if entry != name and INDEX_DIR_PATTERN.fullmatch(entry):
+                shutil.rmtree(os.path.join(SEMANTIC_INDEX_DIR, entry), ignore_errors=True)
+    finally:
+        with _semantic_lock:
+            _semantic_rebuild_pending = False
+
+    # Writes that landed mid-build were folded into this (pending) rebuild.
+    if version != _catalog_version:
+        schedule_semantic_rebuild()
+    return index
+
+
+def get_semantic_index() -> Optional[SemanticIndex]:
+    """
+    The index to query right now, or None before the first build. Never
+    builds inline: a stale or missing index only schedules a rebuild.
+    """
+    global _semantic_index
+    with _semantic_lock:
+        if _semantic_index is None:
+            # Whatever is on disk from a previous run is better than nothing
+            # until the startup rebuild lands.
+            try:
+                with open(os.path.join(SEMANTIC_INDEX_DIR, "CURRENT")) as f:
+                    _semantic_index = SemanticIndex(os.path.join(SEMANTIC_INDEX_DIR, f.read().strip()))
+            except (FileNotFoundError, ValueError):
+                pass
+        index, stale = _semantic_index, _semantic_index_version != _catalog_version
+    if stale:
+        schedule_semantic_rebuild()
+    return index
+
+
+def semantic_find_products(queries: List[str], k: int = 5) -> List[List[Tuple[int, str]]]:
+    """Batched semantic lookup; one (id, name) list per query, best first."""
+    index = get_semantic_index()
+    if index is None:
+        return [[] for _ in queries]
+    hits = [
+        [(pid, score) for pid, score in matches if score >= SEMANTIC_MIN_SCORE]
+        for matches in index.search(queries, k)
+    ]
+    ids = {pid for matches in hits for pid, _ in matches}
+    if not ids:
+        return [[] for _ in queries]
+    with db_session() as session:
+        names = dict(session.exec(select(Product.id, Product.name).where(Product.id.in_(ids))).all())
+    return [[(pid, names[pid]) for pid, _ in matches if pid in names] for matches in hits]
 
 
 def search_and_add(product_name: str, quantity: int = 1) -> str:
-    matches = find_products(product_name)
+    matches = find_products(product_name, limit=1)
     if not matches:
+        # Fuzzy hits are only suggestions; adding them unasked picks the
+        # wrong product too often ("cheese grater" -> Cheddar Cheese).
+        suggestions = semantic_find_products([product_name], k=3)[0]
+        if suggestions:
+            names = ", ".join(name for _, name in suggestions)
+            return f"❓ No exact match for '{product_name}'. Did you mean: {names}?"
         return f"❌ No local product found for '{product_name}'."
 
     pid, name = matches[0]
 
-    with Session(engine) as session:
+    with db_session() as session:
         existing_item = session.exec(
             select(CartItem).where(CartItem.product_id == pid)
         ).first()
@@ -167,38 +679,213 @@ def search_and_add(product_name: str, quantity: int = 1) -> str:
             session.commit()
             return f"✅ Updated {name} in cart to quantity {existing_item.quantity}."
         else:
-            cart_item = add_item_to_cart(pid, quantity)
+            # pid was just read from the catalog, so skip add_item_to_cart's re-check.
+            session.add(CartItem(product_id=pid, quantity=quantity))
+            session.commit()
             return f"✅ Added {name} (id {pid}) to cart with quantity {quantity}."
 
 
 
-llm = ChatGroq(model="llama-3.1-8b-instant")
+UPSTREAM_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPSTREAM_THREADS", "8")), thread_name_prefix="upstream"
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class UpstreamBusyError(Exception):
+    pass
+
+
+class Upstream:
+    """
+    Guards calls to an external service: at most `max_concurrency` calls in
+    flight, a deadline per attempt that starts once a slot is acquired,
+    retries with full-jitter backoff and a circuit breaker that opens after
+    `failure_threshold` consecutive failures. While open, calls skip the
+    upstream and go straight to `fallback`; once `reset_after` seconds pass,
+    a single trial call is let through and its outcome closes or re-opens
+    the circuit. Waiting longer than `timeout` for a slot gives up without
+    counting against the upstream.
+
+    Blocking callables run on UPSTREAM_POOL and keep their slot until the
+    thread actually returns, even if the caller has already timed out.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        max_concurrency: int,
+        retries: int = 1,
+        backoff: float = 0.25,
+        failure_threshold: int = 5,
+        reset_after: float = 30.0,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.max_concurrency = max_concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        if self._opened_at is None:
+            return False
+        return self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_after
+
+    def _admit(self) -> Tuple[bool, bool]:
+        """Returns (allowed, is_trial) for the next attempt."""
+        if self._opened_at is None:
+            return True, False
+        if self.is_open:
+            return False, False
+        self._trial_in_flight = True
+        return True, True
+
+    def _record(self, ok: bool) -> None:
+        self._trial_in_flight = False
+        if ok:
+            self._failures = 0
+            self._opened_at = None
+            return
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # asyncio primitives bind to the first loop that waits on them, and each
+        # lifespan (tests, in-process reloads) runs its own loop.
+        loop = asyncio.get_running_loop()
+        if self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._slots_loop = loop
+        return self._slots
+
+    @staticmethod
+    def _release_from_thread(loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore) -> None:
+        try:
+            loop.call_soon_threadsafe(slots.release)
+        except RuntimeError:
+            pass  # loop already closed; nothing is waiting on the slot
+
+    async def _attempt(self, slots: asyncio.Semaphore, fn: Callable, args, kwargs, blocking: bool):
+        if not blocking:
+            try:
+                return await asyncio.wait_for(fn(*args, **kwargs), self.timeout)
+            finally:
+                slots.release()
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = UPSTREAM_POOL.submit(fn, *args, **kwargs)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: self._release_from_thread(loop, slots))
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    async def call(
+        self,
+        fn: Callable,
+        *args,
+        blocking: bool = False,
+        fallback: Optional[Callable[[], Any]] = None,
+        **kwargs,
+    ):
+        error: Exception = CircuitOpenError(f"{self.name} circuit is open")
+        for attempt in range(self.retries + 1):
+            allowed, trial = self._admit()
+            if not allowed:
+                break
+            try:
+                slots = self._semaphore()
+                try:
+                    await asyncio.wait_for(slots.acquire(), self.timeout)
+                except asyncio.TimeoutError:
+                    error = UpstreamBusyError(f"{self.name} has no free slot")
+                    print(f"⚠️ {error}")
+                    break
+                try:
+                    result = await self._attempt(slots, fn, args, kwargs, blocking)
+                except Exception as exc:
+                    self._record(False)
+                    error = exc
+                    print(f"⚠️ {self.name} attempt {attempt + 1} failed: {exc!r}")
+                else:
+                    self._record(True)
+                    return result
+            finally:
+                # A trial that ends without an outcome (busy, or cancelled by
+                # the caller) must not leave the breaker stuck open.
+                if trial:
+                    self._trial_in_flight = False
+            if attempt < self.retries:
+                await asyncio.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+        if fallback is not None:
+            return fallback()
+        raise error
+
+
+LLM = Upstream(
+    "llm",
+    timeout=float(os.getenv("LLM_TIMEOUT_S", "15")),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+)
+WEB_SEARCH = Upstream(
+    "tavily",
+    timeout=float(os.getenv("WEB_SEARCH_TIMEOUT_S", "10")),
+    max_concurrency=int(os.getenv("WEB_SEARCH_MAX_CONCURRENCY", "4")),
+    retries=2,
+)
+
+# Retries, deadlines and backoff are handled by the Upstream wrappers above.
+llm = ChatGroq(model="llama-3.1-8b-instant", max_retries=0)
 tavily = TavilySearchResults(k=5)
 
+_ingredient_cache: Dict[str, List[str]] = {}
+
 
-def tavily_ingredient_search(dish: str) -> List[str]:
-    result = tavily.run(f"list ingredients used to make {dish}")
+async def tavily_ingredient_search(dish: str) -> List[str]:
+    key = dish.strip().lower()
+    result = await WEB_SEARCH.call(
+        tavily.run,
+        f"list ingredients used to make {dish}",
+        blocking=True,
+        fallback=lambda: None,
+    )
+    if result is None:
+        return _ingredient_cache.get(key, [])
     if isinstance(result, list):
-        return [r["title"] for r in result if "title" in r]
+        ingredients = [r["title"] for r in result if "title" in r]
+        _ingredient_cache[key] = ingredients
+        return ingredients
     return []
 
 
 def find_cart_items_by_name(name: str):
-    items = describe_cart()
-    matched = []
-    for item in items:
-        if name.lower() in item["product"]["name"].lower():
-            matched.append((item["cart_item_id"], item["product"]["name"]))
-    return matched
+    with db_session() as session:
+        statement = (
+            select(CartItem.id, Product.name)
+            .join(Product)
+            .where(Product.name.ilike(f"%{name}%"))
+            .order_by(CartItem.id)
+        )
+        return [(item_id, product_name) for item_id, product_name in session.exec(statement).all()]
 
 
 def delete_cart_item_by_name(name: str):
-    items = describe_cart()
-    for item in items:
-        if name.lower() in item["product"]["name"].lower():
-            delete_item_from_cart(item["cart_item_id"])
-            return f"✅ Deleted '{item['product']['name']}' from the cart (cart_item_id={item['cart_item_id']})."
-    return f"⚠️ No item matching '{name}' found in the cart."
+    return search_and_delete(name)
 
 
 def search_and_delete(product_name: str) -> str:
@@ -206,14 +893,57 @@ def search_and_delete(product_name: str) -> str:
     Searches the cart for a product by name and deletes the first match.
     Ensures it deletes only once.
     """
-    items = describe_cart()
-    for item in items:
-        if product_name.lower() in item["product"]["name"].lower():
-            delete_item_from_cart(item["cart_item_id"])
-            return f"✅ Deleted '{item['product']['name']}' from the cart (cart_item_id={item['cart_item_id']})."
-    return f"⚠️ No item matching '{product_name}' found in the cart."
+    with db_session() as session:
+        match = session.exec(
+            select(CartItem, Product.name)
+            .join(Product)
+            .where(Product.name.ilike(f"%{product_name}%"))
+            .order_by(CartItem.id)
+            .limit(1)
+        ).first()
+        if not match:
+            return f"⚠️ No item matching '{product_name}' found in the cart."
+
+        item, name = match
+        session.delete(item)
+        session.commit()
+        return f"✅ Deleted '{name}' from the cart (cart_item_id={item.id})."
+
+
+MAX_OBSERVATION_CHARS = int(os.getenv("MAX_OBSERVATION_CHARS", "600"))
+
+
+def cart_lines() -> List[CartLine]:
+    """Cart as ids, names and quantities only — what the LLM actually needs."""
+    with db_session() as session:
+        rows = session.exec(
+            select(CartItem.id, Product.id, Product.name, CartItem.quantity).join(Product)
+        ).all()
+        return [
+            CartLine(id=item_id, product_id=pid, name=name, quantity=quantity)
+            for item_id, pid, name, quantity in rows
+        ]
 
 
+def compact_observation(obs: Any, max_chars: int = MAX_OBSERVATION_CHARS) -> str:
+    """Serialises a tool result tightly and clips it to the context budget."""
+    if isinstance(obs, str):
+        text = obs
+    else:
+        if isinstance(obs, list):
+            obs = [o.model_dump() if isinstance(o, BaseModel) else o for o in obs]
+        elif isinstance(obs, BaseModel):
+            obs = obs.model_dump()
+        text = json.dumps(obs, separators=(",", ":"), ensure_ascii=False, default=str)
+
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}… [{len(text) - max_chars} chars truncated]"
+
+
+async def _compact_ingredients(dish: str) -> str:
+    return compact_observation(await tavily_ingredient_search(dish))
+
 
 tools = [
     Tool(
@@ -228,14 +958,24 @@ tools = [
     # ),
     Tool(
         name="find_cart_items_by_name",
-        func=find_cart_items_by_name,
+        func=lambda name: compact_observation(find_cart_items_by_name(name)),
         description="Find items in the cart by product name; returns (cart_item_id, product name)",
     ),
     Tool(
         name="find_products",
-        func=find_products,
+        func=lambda query: compact_observation(find_products(query)),
         description="Search available products by keyword; returns list of (id, name).",
     ),
+    Tool(
+        name="semantic_find_products",
+        func=lambda names: compact_observation(
+            semantic_find_products([n.strip() for n in names.split(",") if n.strip()])
+        ),
+        description=(
+            "Fuzzy catalog lookup for loosely worded names. Takes a comma-separated "
+            "list (e.g. dish ingredients); returns one list of (id, name) per entry."
+        ),
+    ),
     Tool(
         name="add_item",
         func=lambda pid, qty=1: add_item_to_cart(int(pid), int(qty)),
@@ -253,7 +993,8 @@ tools = [
     ),
     Tool(
         name="web_search_ingredients",
-        func=tavily_ingredient_search,
+        func=None,
+        coroutine=lambda dish: _compact_ingredients(dish),
         description=(
             "Use this first when the user asks for a DISH (e.g. 'ingredients of pizza'). "
             "It returns a list of ingredient names."
@@ -268,13 +1009,20 @@ tools = [
             "Use this for each ingredient or product the user wants."
         ),
     ),
+    Tool(
+        name="cart_summary",
+        func=lambda days=3: compact_observation(cart_summary(int(days))),
+        description=(
+            "Totals for the cart: price, green score, items expiring within "
+            "N days (default 3) and potential savings. Prefer this over describe_cart."
+        ),
+    ),
     Tool(
         name="describe_cart",
-        func=describe_cart,
+        func=lambda *_: compact_observation(cart_lines()),
         description=(
-            "Call this ONCE after you've finished modifying the cart. "
-            "It returns a summary you can show to the user. "
-            "After calling it, respond with:  Final Answer: <your reply>"
+            "Call ONCE after modifying the cart; returns [{id, product_id, name, quantity}]. "
+            "Then respond with:  Final Answer: <your reply>"
         ),
     ),
 ]
@@ -341,8 +1089,9 @@ DECIDE_PROMPT = ChatPromptTemplate.from_messages(
 You are a cart assistant. Classify the user message into one of the following actions:
 - ADD <product name>
 - REMOVE <product name>
+- SUMMARY (the user asks about cart totals, green score, what expires soon or possible savings)
 If the message is unrelated, output NONE.
-Respond with only the action and product, e.g., `ADD oat milk` or `REMOVE sugar`. Do not include punctuation.
+Respond with only the action and product, e.g., `ADD oat milk`, `REMOVE sugar` or `SUMMARY`. Do not include punctuation.
 """,
         ),
         ("user", "{user_message}"),
@@ -361,15 +1110,31 @@ FINAL_PROMPT = ChatPromptTemplate.from_messages(
 )
 
 
-from typing import Literal
+# System messages never change between turns, so render them once and send
+# the identical prefix every call (lets the provider reuse its prompt cache).
+DECIDE_PREFIX = [DECIDE_PROMPT.messages[0].format()]
+FINAL_PREFIX = [FINAL_PROMPT.messages[0].format()]
+
+
 
 
 class AgentState(TypedDict, total=False):
     user_message: str
-    intent: Optional[Literal["add", "remove"]] 
+    intent: Optional[Literal["add", "remove", "summary"]]
     product: Optional[str]  
     tool_output: Optional[str]
     final_message: Optional[str]
+    usage: Dict[str, int]
+
+
+def record_usage(state: AgentState, response: BaseMessage) -> Dict[str, int]:
+    """Adds one LLM call's token counts to the running per-turn totals."""
+    usage = dict(state.get("usage") or {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    meta = getattr(response, "usage_metadata", None) or {}
+    usage["llm_calls"] += 1
+    usage["prompt_tokens"] += meta.get("input_tokens", 0)
+    usage["completion_tokens"] += meta.get("output_tokens", 0)
+    return usage
 
 
 
@@ -382,13 +1147,43 @@ async def add_product(state: AgentState) -> AgentState:
     return state
 
 
+INTENT_PATTERN = re.compile(
+    r"^\s*(?:please\s+)?(add|remove|delete)\s+(.+?)"
+    r"(?:\s+(?:to|from)\s+(?:my\s+|the\s+)?cart)?[\s.!]*$",
+    re.IGNORECASE,
+)
+
+SUMMARY_PATTERN = re.compile(r"\b(summary|summarise|summarize|total|expir\w*|savings?)\b", re.IGNORECASE)
+
+
+def rule_based_intent(message: str) -> Tuple[Optional[str], Optional[str]]:
+    """Fallback classifier used when the LLM is unavailable."""
+    match = INTENT_PATTERN.match(message)
+    if not match:
+        if SUMMARY_PATTERN.search(message):
+            return "summary", None
+        return None, None
+    verb, product = match.groups()
+    return ("add" if verb.lower() == "add" else "remove"), product.strip()
+
+
 async def decide_intent(state: AgentState) -> AgentState:
-    prompt = DECIDE_PROMPT.format(user_message=state["user_message"])
-    result = await llm.ainvoke(prompt)
+    result = await LLM.call(
+        llm.ainvoke,
+        [*DECIDE_PREFIX, HumanMessage(content=state["user_message"])],
+        fallback=lambda: None,
+    )
+    if result is None:
+        intent, product = rule_based_intent(state["user_message"])
+        return {**state, "intent": intent, "product": product}
+
+    state = {**state, "usage": record_usage(state, result)}
     response = result.content.strip()
 
     if response.upper() == "NONE":
         return {**state, "intent": None, "product": None}
+    if response.upper() == "SUMMARY":
+        return {**state, "intent": "summary", "product": None}
 
     parts = response.split(maxsplit=1)
     if len(parts) != 2:
@@ -402,16 +1197,21 @@ async def decide_intent(state: AgentState) -> AgentState:
 async def handle_cart_action(state: AgentState) -> AgentState:
     intent = state.get("intent")
     product = state.get("product")
-    if not intent or not product:
-        return {**state, "tool_output": None}
-
-    if intent == "add":
+    if intent == "summary":
+        obs = cart_summary()
+    elif not intent or not product:
+        obs = None
+    elif intent == "add":
         obs = search_and_add(product)
     elif intent == "remove":
         obs = search_and_delete(product)
     else:
         obs = "Unknown intent."
-    return {**state, "tool_output": obs}
+
+    # "final" is an LLM call that can take seconds; don't hold the request's
+    # connection (idle in transaction on Postgres) while it runs.
+    end_transaction()
+    return {**state, "tool_output": compact_observation(obs) if obs is not None else None}
 
 
 SMALL_TALK_PROMPT = ChatPromptTemplate.from_messages(
@@ -423,20 +1223,31 @@ SMALL_TALK_PROMPT = ChatPromptTemplate.from_messages(
         ("user", "{user_message}"),
     ]
 )
+SMALL_TALK_PREFIX = [SMALL_TALK_PROMPT.messages[0].format()]
+SMALL_TALK_FALLBACK = "Hi! 🛒 Tell me what to add to or remove from your cart, e.g. \"add oat milk\"."
 
 
 async def final_response(state: AgentState) -> AgentState:
     tool_output = state.get("tool_output")
 
     if tool_output:
-        prompt = FINAL_PROMPT.format(tool_output=tool_output)
-        res = await llm.ainvoke(prompt)
-        return {**state, "final_message": res.content}
+        res = await LLM.call(
+            llm.ainvoke, [*FINAL_PREFIX, AIMessage(content=tool_output)], fallback=lambda: None
+        )
+        if res is None:
+            # The tool output is already a readable sentence.
+            return {**state, "final_message": tool_output}
+        return {**state, "final_message": res.content, "usage": record_usage(state, res)}
 
     # If there's no cart action, respond in personality
-    fallback = SMALL_TALK_PROMPT.format(user_message=state["user_message"])
-    reply = await llm.ainvoke(fallback)
-    return {**state, "final_message": reply.content}
+    reply = await LLM.call(
+        llm.ainvoke,
+        [*SMALL_TALK_PREFIX, HumanMessage(content=state["user_message"])],
+        fallback=lambda: None,
+    )
+    if reply is None:
+        return {**state, "final_message": SMALL_TALK_FALLBACK}
+    return {**state, "final_message": reply.content, "usage": record_usage(state, reply)}
 
 
 
@@ -454,9 +1265,148 @@ graph.add_edge("final", END)
 graph.set_entry_point("decide")
 agent = graph.compile()
 
+# Same flow without the "final" LLM call, for requests that take the
+# structured tool output now and pick up the phrased reply later.
+quick_graph = StateGraph(AgentState)
+quick_graph.add_node("decide", decide_intent)
+quick_graph.add_node("handle", handle_cart_action)
+quick_graph.add_edge("decide", "handle")
+quick_graph.add_edge("handle", END)
+quick_graph.set_entry_point("decide")
+quick_agent = quick_graph.compile()
+
+
+class WorkQueue:
+    """
+    In-process queue for work that shouldn't hold up a response. A fixed pool
+    of worker tasks drains a bounded asyncio.Queue; `submit` never waits, it
+    returns False when the queue is full or not running so callers can run
+    the job inline instead (backpressure).
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: Optional["asyncio.Queue[Tuple[str, Callable[[], Any], Optional[Callable[[], None]]]]"] = None
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self) -> None:
+        # A fresh queue per start: asyncio queues bind to the loop that first
+        # uses them, and each lifespan (tests, in-process reloads) has its own.
+        self._queue = asyncio.Queue(self.maxsize)
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(
+        self, name: str, job: Callable[[], Any], on_drop: Optional[Callable[[], None]] = None
+    ) -> bool:
+        """
+        Safe to call from worker threads (e.g. sync endpoints): the job is
+        then handed to the loop, and dropped with a warning if the queue is full.
+        `on_drop` runs whenever an accepted job is dropped without running
+        (full queue after a cross-thread submit, or left over at shutdown).
+        """
+        if not self.running:
+            return False
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            self._loop.call_soon_threadsafe(self._put_or_drop, name, job, on_drop)
+            return True
+        try:
+            self._queue.put_nowait((name, job, on_drop))
+        except asyncio.QueueFull:
+            print(f"⚠️ Work queue full, running '{name}' inline.")
+            return False
+        return True
+
+    def _put_or_drop(
+        self, name: str, job: Callable[[], Any], on_drop: Optional[Callable[[], None]]
+    ) -> None:
+        try:
+            self._queue.put_nowait((name, job, on_drop))
+        except asyncio.QueueFull:
+            print(f"⚠️ Work queue full, dropping '{name}'.")
+            self._dropped(name, on_drop)
+
+    @staticmethod
+    def _dropped(name: str, on_drop: Optional[Callable[[], None]]) -> None:
+        if on_drop is None:
+            return
+        try:
+            on_drop()
+        except Exception as exc:
+            print(f"⚠️ Drop handler for '{name}' failed: {exc!r}")
+
+    async def _worker(self) -> None:
+        while True:
+            name, job, _ = await self._queue.get()
+            try:
+                result = job()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as exc:
+                print(f"⚠️ Background job '{name}' failed: {exc!r}")
+            finally:
+                self._queue.task_done()
+
+    async def shutdown(self, timeout: float) -> None:
+        """Lets queued jobs finish for up to `timeout` seconds, then cancels."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Dropping {self._queue.qsize()} background job(s) on shutdown.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            name, _, on_drop = self._queue.get_nowait()
+            self._dropped(name, on_drop)
+
+
+work_queue = WorkQueue(
+    workers=int(os.getenv("WORK_QUEUE_WORKERS", "4")),
+    maxsize=int(os.getenv("WORK_QUEUE_SIZE", "256")),
+)
+
+MAX_DEFERRED_MESSAGES = 1000
+deferred_messages: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def run_in_background(
+    name: str, job: Callable[[], Any], on_drop: Optional[Callable[[], None]] = None
+) -> Optional[Awaitable]:
+    """Queues `job`; if the queue refuses it, returns an awaitable to run it inline."""
+    if work_queue.submit(name, job, on_drop=on_drop):
+        return None
+
+    async def inline():
+        result = job()
+        if inspect.isawaitable(result):
+            await result
 
+    return inline()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    work_queue.start()
+    schedule_semantic_rebuild()
+    yield
+    # UPSTREAM_POOL is process-wide and outlives any one lifespan, so it is
+    # left running here.
+    await work_queue.shutdown(timeout=float(os.getenv("WORK_QUEUE_DRAIN_S", "10")))
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:8081",
@@ -473,14 +1423,18 @@ app.add_middleware(
 from fastapi import Body
 
 
+@app.middleware("http")
+async def request_unit_of_work(request: Request, call_next):
+    """One session per request, shared by every helper and agent tool."""
+    with unit_of_work():
+        return await call_next(request)
+
+
 class SwapRequest(BaseModel):
     cart_item_id: int
     alternative: str  
 
 
-from sqlalchemy import func
-
-
 @app.post("/cart/swap")
 def swap_cart_item(data: SwapRequest):
     """
@@ -489,7 +1443,7 @@ def swap_cart_item(data: SwapRequest):
     cart_item_id = data.cart_item_id
     alt_name = data.alternative.strip().lower()
 
-    with Session(engine) as session:
+    with db_session() as session:
         # Fetch the cart item
         cart_line = session.get(CartItem, cart_item_id)
         if not cart_line:
@@ -505,7 +1459,6 @@ def swap_cart_item(data: SwapRequest):
         cart_line.product_id = alt_product.id
         session.add(cart_line)
         session.commit()
-        session.refresh(cart_line)
 
         return {
             "cart_item_id": cart_line.id,
@@ -525,15 +1478,74 @@ def swap_cart_item(data: SwapRequest):
 
 
 @app.post("/agent")
-async def chat(input_: AgentInput):
-    result = await agent.ainvoke({"user_message": input_.message})
-    print(result)
-    return {"response": result}
+async def chat(input_: AgentInput, defer: bool = False):
+    """
+    With `defer=true` the cart action runs and its `tool_output` is returned
+    immediately; the phrased reply is produced in the background and can be
+    fetched from /agent/messages/{message_id}.
+    """
+    if not defer:
+        result = await agent.ainvoke({"user_message": input_.message})
+        print(result)
+        print("🔢 tokens:", result.get("usage"))
+        return {"response": result}
+
+    state = await quick_agent.ainvoke({"user_message": input_.message})
+    message_id = uuid.uuid4().hex
+    deferred_messages[message_id] = {"status": "pending"}
+    while len(deferred_messages) > MAX_DEFERRED_MESSAGES:
+        deferred_messages.popitem(last=False)
+
+    def mark_failed():
+        deferred_messages[message_id] = {"status": "failed"}
+
+    async def compose_reply():
+        try:
+            result = await final_response(state)
+        except BaseException:  # cancellation too, or the entry stays pending
+            mark_failed()
+            raise
+        print("🔢 tokens:", result.get("usage"))
+        deferred_messages[message_id] = {
+            "status": "done",
+            "final_message": result["final_message"],
+            "usage": result.get("usage"),
+        }
+
+    inline = run_in_background("compose_reply", compose_reply, on_drop=mark_failed)
+    if inline is not None:
+        await inline
+    return {"response": state, "message_id": message_id}
+
+
+@app.get("/agent/messages/{message_id}")
+def get_deferred_message(message_id: str):
+    message = deferred_messages.get(message_id)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"message_id": message_id, **message}
 
 
 @app.get("/cart")
-def get_cart():
-    return describe_cart()
+def get_cart(params: Annotated[ListingParams, Query()]):
+    """
+    Without `limit`/`cursor` this returns the whole cart as a list, as before;
+    with them it returns {"items", "next_cursor"} pages.
+    """
+    page = list_cart(params)
+    if params.limit is None and params.cursor is None:
+        return page["items"]
+    return page
+
+
+@app.get("/products")
+def get_products(params: Annotated[ListingParams, Query()]):
+    return list_products(params)
+
+
+@app.get("/cart/summary")
+def get_cart_summary(within_days: int = 3):
+    return cart_summary(within_days)
 
 
 @app.post("/cart/add")
@@ -806,7 +1818,7 @@ def seed_products():
         },
     ]
 
-    with Session(engine) as session:
+    with db_session() as session:
         SQLModel.metadata.create_all(engine)
         existing = session.exec(select(Product)).all()
         if not existing:
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from langchain_core.messages import AIMessage
+
+_tmp = tempfile.mkdtemp(prefix="ecocart-tests-")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/cart.db"
+os.environ["SEMANTIC_INDEX_DIR"] = os.path.join(_tmp, "semantic_index")
+
+import langchain_community.tools
+
+
+class FakeTavily:
+    """Stands in for TavilySearchResults, which server.py can't build with a blank API key."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def run(self, query):
+        return []
+
+
+langchain_community.tools.TavilySearchResults = FakeTavily
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeLLM:
+    """Replies with the queued strings in order and records every prompt."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+
+    async def ainvoke(self, messages):
+        self.calls.append(messages)
+        return AIMessage(
+            content=self.replies.pop(0),
+            usage_metadata={"input_tokens": 10, "output_tokens": 3, "total_tokens": 13},
+        )
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    import server
+
+    def install(*replies):
+        llm = FakeLLM(*replies)
+        monkeypatch.setattr(server, "llm", llm)
+        return llm
+
+    return install
+
+
+@pytest.fixture
+def client():
+    """App with its lifespan running, seeded catalog and an empty cart."""
+    from fastapi.testclient import TestClient
+    from sqlmodel import delete
+
+    import server
+
+    with TestClient(server.app) as test_client:
+        test_client.post("/seed-products")
+        with server.db_session() as session:
+            session.exec(delete(server.CartItem))
+            session.commit()
+        yield test_client
@@ -0,0 +1,59 @@
+import pytest
+from sqlmodel import select
+
+import server
+from server import Product
+
+
+def product_id(name):
+    with server.db_session() as session:
+        return session.exec(select(Product.id).where(Product.name == name)).one()
+
+
+@pytest.fixture
+def cart(client):
+    # Mozzarella and yogurt carry alternatives.price.savings; Pizza Dough has
+    # empty alternatives and Cheddar has none at all.
+    for name, quantity in [
+        ("Mozzarella Cheese", 2),  # 250, green 80, 5 days, saves 50
+        ("Organic Greek Yogurt", 1),  # 399, green 85, 2 days, saves 120
+        ("Pizza Dough", 3),  # 150, green 75, 3 days
+        ("Cheddar Cheese", 1),  # 200, green 75, 10 days
+    ]:
+        client.post("/cart/add", json={"product_id": product_id(name), "quantity": quantity})
+    return client
+
+
+def test_empty_cart(client):
+    summary = client.get("/cart/summary").json()
+
+    assert summary["lines"] == summary["units"] == 0
+    assert summary["total_price"] == summary["potential_savings"] == 0
+    assert summary["green_score"] is None
+    assert summary["expiring_soon"] == []
+
+
+def test_totals_and_savings(cart):
+    summary = cart.get("/cart/summary").json()
+
+    assert (summary["lines"], summary["units"]) == (4, 7)
+    assert summary["total_price"] == 500 + 399 + 450 + 200
+    assert summary["green_score"] == round((160 + 85 + 225 + 75) / 7, 1)
+    assert summary["potential_savings"] == 2 * 50 + 120
+
+
+@pytest.mark.parametrize(
+    "within_days, units, names",
+    [
+        (1, 0, []),
+        (2, 1, ["Organic Greek Yogurt"]),
+        (3, 4, ["Organic Greek Yogurt", "Pizza Dough"]),
+        (5, 6, ["Organic Greek Yogurt", "Pizza Dough", "Mozzarella Cheese"]),
+    ],
+)
+def test_expiry_window_is_inclusive(cart, within_days, units, names):
+    summary = cart.get("/cart/summary", params={"within_days": within_days}).json()
+
+    assert summary["expiring_within_days"] == within_days
+    assert summary["expiring_units"] == units
+    assert [line["name"] for line in summary["expiring_soon"]] == names
@@ -0,0 +1,55 @@
+import json
+
+from langchain_core.messages import AIMessage
+
+import server
+from server import CartLine, compact_observation
+
+
+def test_short_observation_is_untouched():
+    assert compact_observation("✅ Added Bananas") == "✅ Added Bananas"
+
+
+def test_long_observation_is_clipped_with_marker():
+    clipped = compact_observation("x" * 700, max_chars=600)
+
+    assert clipped == "x" * 600 + "… [100 chars truncated]"
+
+
+def test_structures_are_serialised_tightly():
+    assert compact_observation([(1, "Bananas")]) == '[[1,"Bananas"]]'
+    assert compact_observation({"a": 1}) == '{"a":1}'
+
+
+def test_cart_lines_carry_only_ids_names_and_quantities(client):
+    client.post("/cart/add", json={"product_id": 1, "quantity": 2})
+
+    [line] = json.loads(compact_observation(server.cart_lines()))
+
+    assert set(line) == set(CartLine.model_fields) == {"id", "product_id", "name", "quantity"}
+    assert (line["product_id"], line["quantity"]) == (1, 2)
+
+
+def test_usage_adds_up_over_one_agent_turn(client, monkeypatch):
+    replies = iter(
+        [
+            AIMessage(content="ADD bananas", usage_metadata={"input_tokens": 120, "output_tokens": 4, "total_tokens": 124}),
+            AIMessage(content="Added!", usage_metadata={"input_tokens": 45, "output_tokens": 9, "total_tokens": 54}),
+        ]
+    )
+
+    class MeteredLLM:
+        async def ainvoke(self, messages):
+            return next(replies)
+
+    monkeypatch.setattr(server, "llm", MeteredLLM())
+
+    state = client.post("/agent", json={"message": "add bananas"}).json()["response"]
+
+    assert state["usage"] == {"llm_calls": 2, "prompt_tokens": 165, "completion_tokens": 13}
+
+
+def test_usage_tolerates_missing_metadata():
+    usage = server.record_usage({}, AIMessage(content="hi"))
+
+    assert usage == {"llm_calls": 1, "prompt_tokens": 0, "completion_tokens": 0}
@@ -0,0 +1,61 @@
+import base64
+import json
+
+
+def cursor(*payload):
+    return base64.urlsafe_b64encode(json.dumps(list(payload)).encode()).decode()
+
+
+def test_products_pages_cover_catalog_once(client):
+    seen, next_cursor = [], None
+    while True:
+        params = {"limit": 4, "sort": "price", "order": "desc", "fields": "name,price"}
+        if next_cursor:
+            params["cursor"] = next_cursor
+        page = client.get("/products", params=params).json()
+        seen += page["items"]
+        next_cursor = page["next_cursor"]
+        if not next_cursor:
+            break
+
+    prices = [item["price"] for item in seen]
+    assert prices == sorted(prices, reverse=True)
+    assert len({item["name"] for item in seen}) == len(seen) == len(client.get("/products?limit=200").json()["items"])
+    assert set(seen[0]) == {"name", "price"}
+
+
+def test_cursor_with_bad_sort_value_is_rejected(client):
+    bad_cursors = [
+        cursor("price", "asc", {"a": 1}, 1),
+        cursor("price", "asc", "10", 1),
+        cursor("price", "asc", None, 1),
+        cursor("price", "asc", float("inf"), 1),
+        cursor("price", "asc", float("nan"), 1),
+        cursor("price", "asc", 10, "x"),
+        cursor("price", "asc", 10, float("inf")),
+        cursor("price", "asc", 10, float("nan")),
+        cursor("price", "asc", 10, 1e300),
+        cursor("price", "asc", 10, 10**30),
+        cursor("price", "asc", 10**30, 1),
+    ]
+    for bad in bad_cursors:
+        response = client.get("/products", params={"sort": "price", "cursor": bad})
+        assert response.status_code == 400, bad
+
+
+def test_cursor_reused_under_other_sort_is_rejected(client):
+    page = client.get("/products", params={"limit": 2, "sort": "price"}).json()
+
+    response = client.get("/products", params={"sort": "green_score", "cursor": page["next_cursor"]})
+    assert response.status_code == 400
+    response = client.get("/products", params={"sort": "price", "order": "desc", "cursor": page["next_cursor"]})
+    assert response.status_code == 400
+
+
+def test_cart_without_paging_keeps_list_shape(client):
+    client.post("/cart/add", json={"product_id": 1, "quantity": 2})
+
+    [line] = client.get("/cart").json()
+
+    assert line["quantity"] == 2
+    assert set(line["product"]) == {"id", "name", "price", "image", "expiry_date", "green_score", "alternatives"}
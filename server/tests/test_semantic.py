@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import time
+
+import numpy as np
+
+import server
+from server import Product
+
+
+def wait_for_index(timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server._semantic_index is not None and server._semantic_index_version == server._catalog_version:
+            return server._semantic_index
+        time.sleep(0.02)
+    raise AssertionError("semantic index was not rebuilt")
+
+
+def test_index_search_ranks_closest_name_first(tmp_path):
+    index = server.SemanticIndex.build([1, 2, 3], ["Frozen Mozzarella", "Pizza Dough", "Bananas"], str(tmp_path))
+
+    [hits] = index.search(["mozzarella for pizza"], k=3)
+
+    assert hits[0][0] == 1
+    assert isinstance(index.vectors, np.memmap)
+
+
+def test_fuzzy_match_is_suggested_not_added(client):
+    wait_for_index()
+
+    reply = server.search_and_add("cheese grater")
+
+    assert reply.startswith("❓ No exact match for 'cheese grater'. Did you mean:")
+    assert "Cheddar Cheese" in reply
+    assert client.get("/cart").json() == []
+
+
+def test_lookup_never_counts_or_builds(client):
+    wait_for_index()
+
+    with server.count_statements() as statements:
+        server.semantic_find_products(["mozzarella", "yogurt"])
+
+    assert statements[0] == 1  # just the id -> name lookup
+
+
+def test_rename_rebuilds_in_background(client):
+    wait_for_index()
+    version = server._catalog_version
+    with server.db_session() as session:
+        product = session.get(Product, 1)
+        original = product.name
+        product.name = "Buffalo Burrata"
+        session.add(product)
+        session.commit()
+
+    try:
+        assert server._catalog_version == version + 1
+        wait_for_index()
+        assert server.semantic_find_products(["burrata"], k=1) == [[(1, "Buffalo Burrata")]]
+    finally:
+        with server.db_session() as session:
+            product = session.get(Product, 1)
+            product.name = original
+            session.add(product)
+            session.commit()
+        wait_for_index()
+
+
+def pending_after(monkeypatch, scenario):
+    queue = server.WorkQueue(workers=1, maxsize=1)
+    monkeypatch.setattr(server, "work_queue", queue)
+    monkeypatch.setattr(server, "_semantic_rebuild_pending", False)
+
+    async def run():
+        queue.start()
+        gate = asyncio.Event()
+        queue.submit("busy", gate.wait)
+        await asyncio.sleep(0)
+        await scenario(queue, gate)
+        return server._semantic_rebuild_pending
+
+    return asyncio.run(run())
+
+
+def test_rebuild_dropped_on_full_queue_can_be_rescheduled(monkeypatch):
+    async def scenario(queue, gate):
+        assert queue.submit("fill", gate.wait)
+        # From a thread, submit can't see the queue is full; the job is dropped on the loop.
+        assert await asyncio.to_thread(server.schedule_semantic_rebuild)
+        await asyncio.sleep(0.01)
+        gate.set()
+        await queue.shutdown(1)
+
+    assert pending_after(monkeypatch, scenario) is False
+
+
+def test_rebuild_dropped_on_shutdown_can_be_rescheduled(monkeypatch):
+    async def scenario(queue, gate):
+        assert server.schedule_semantic_rebuild()
+        await queue.shutdown(0.05)
+
+    assert pending_after(monkeypatch, scenario) is False
+
+
+def test_rebuild_only_removes_its_own_directories(client):
+    wait_for_index()
+    unrelated = os.path.join(server.SEMANTIC_INDEX_DIR, "uploads")
+    stale = os.path.join(server.SEMANTIC_INDEX_DIR, f"index-{'0' * 32}")
+    os.makedirs(unrelated)
+    os.makedirs(stale)
+
+    server.rebuild_semantic_index()
+
+    assert os.path.isdir(unrelated)
+    assert not os.path.exists(stale)
+    shutil.rmtree(unrelated)
@@ -0,0 +1,83 @@
+"""
+Upper bounds on SQL statements per endpoint. A failure here usually means a
+helper went back to loading the cart or a row per item (N+1).
+"""
+import pytest
+
+import server
+from conftest import FakeLLM
+from test_semantic import wait_for_index
+
+
+@pytest.fixture
+def cart(client):
+    wait_for_index()  # a background rebuild would add its own statements
+    for product_id, quantity in [(1, 2), (7, 1), (5, 3)]:
+        client.post("/cart/add", json={"product_id": product_id, "quantity": quantity})
+    return [line["cart_item_id"] for line in client.get("/cart").json()]
+
+
+def statements_for(send):
+    with server.count_statements() as statements:
+        response = send()
+    assert response.status_code == 200, response.text
+    return statements[0]
+
+
+@pytest.mark.parametrize(
+    "method, path, body, budget",
+    [
+        ("get", "/cart", None, 1),
+        ("get", "/cart?limit=2&sort=price&fields=name,price", None, 1),
+        ("get", "/cart/summary", None, 2),
+        ("get", "/products?limit=5", None, 1),
+        ("post", "/cart/add", {"product_id": 2, "quantity": 1}, 2),
+        ("patch", "/cart/update", {"id": "{line}", "quantity": 4}, 2),
+        ("post", "/cart/swap", {"cart_item_id": "{line}", "alternative": "Cheddar Cheese"}, 3),
+        ("delete", "/cart/{line}", None, 2),
+    ],
+)
+def test_endpoint_budget(client, cart, method, path, body, budget):
+    line = cart[0]
+    path = path.replace("{line}", str(line))
+    if body:
+        body = {k: line if v == "{line}" else v for k, v in body.items()}
+
+    send = getattr(client, method)
+    count = statements_for(lambda: send(path, json=body) if body else send(path))
+
+    assert count <= budget
+
+
+@pytest.mark.parametrize(
+    "message, replies, budget",
+    [
+        ("add yogurt", ["ADD yogurt", "Done"], 3),  # find, existing line, update
+        ("add basil", ["ADD basil", "Done"], 3),  # find, existing line, insert
+        ("add cheese grater", ["ADD cheese grater", "Done"], 2),  # find, suggestion names
+        ("remove dough", ["REMOVE dough", "Done"], 2),  # find line, delete
+        ("what's my total?", ["SUMMARY", "Done"], 2),
+        ("hello", ["NONE", "Hi"], 0),
+    ],
+)
+def test_agent_budget(client, cart, fake_llm, message, replies, budget):
+    fake_llm(*replies)
+
+    count = statements_for(lambda: client.post("/agent", json={"message": message}))
+
+    assert count <= budget
+
+
+def test_agent_releases_connection_before_final_llm_call(client, cart, monkeypatch):
+    class ObservingLLM(FakeLLM):
+        async def ainvoke(self, messages):
+            self.checked_out = server.engine.pool.checkedout()
+            return await super().ainvoke(messages)
+
+    llm = ObservingLLM("ADD nothing-like-this", "Sorry")
+    monkeypatch.setattr(server, "llm", llm)
+
+    response = client.post("/agent", json={"message": "add nothing-like-this"})
+
+    assert response.status_code == 200
+    assert llm.checked_out == 0  # recorded during the final call
@@ -0,0 +1,264 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import server
+from server import CircuitOpenError, Upstream, UpstreamBusyError
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeUpstream:
+    """Async and blocking fake service with injectable latency and failures."""
+
+    def __init__(self, latency=0.0, fail_times=0):
+        self.latency = latency
+        self.fail_times = fail_times
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return self.calls <= self.fail_times
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    async def acall(self, value="ok"):
+        should_fail = self._enter()
+        try:
+            await asyncio.sleep(self.latency)
+            if should_fail:
+                raise ConnectionError("upstream down")
+            return value
+        finally:
+            self._exit()
+
+    def call(self, value="ok"):
+        should_fail = self._enter()
+        try:
+            time.sleep(self.latency)
+            if should_fail:
+                raise ConnectionError("upstream down")
+            return value
+        finally:
+            self._exit()
+
+
+def test_deadline_cuts_off_slow_call():
+    up = Upstream("t", timeout=0.05, max_concurrency=1, retries=0)
+    fake = FakeUpstream(latency=1.0)
+
+    started = time.monotonic()
+    result = run(up.call(fake.acall, fallback=lambda: "fallback"))
+
+    assert result == "fallback"
+    assert time.monotonic() - started < 0.5
+
+
+def test_retries_then_raises_last_error():
+    up = Upstream("t", timeout=1, max_concurrency=1, retries=2, backoff=0.001)
+    fake = FakeUpstream(fail_times=10)
+
+    with pytest.raises(ConnectionError):
+        run(up.call(fake.acall))
+    assert fake.calls == 3
+
+
+def test_retry_recovers_from_transient_failure():
+    up = Upstream("t", timeout=1, max_concurrency=1, retries=1, backoff=0.001)
+    fake = FakeUpstream(fail_times=1)
+
+    assert run(up.call(fake.call, "done", blocking=True)) == "done"
+    assert fake.calls == 2
+
+
+def test_semaphore_caps_async_calls():
+    up = Upstream("t", timeout=1, max_concurrency=2, retries=0)
+    fake = FakeUpstream(latency=0.05)
+
+    async def burst():
+        return await asyncio.gather(*(up.call(fake.acall) for _ in range(6)))
+
+    assert run(burst()) == ["ok"] * 6
+    assert fake.peak == 2
+
+
+def test_semaphore_holds_until_blocking_thread_finishes():
+    up = Upstream("t", timeout=0.05, max_concurrency=2, retries=0, failure_threshold=100)
+    fake = FakeUpstream(latency=0.3)
+
+    async def burst():
+        first = await asyncio.gather(*(up.call(fake.call, blocking=True, fallback=lambda: None) for _ in range(3)))
+        # Callers have timed out, but their threads are still running.
+        second = await asyncio.gather(*(up.call(fake.call, blocking=True, fallback=lambda: None) for _ in range(3)))
+        return first + second
+
+    assert run(burst()) == [None] * 6
+    assert fake.peak <= 2
+    time.sleep(0.4)
+    assert fake.in_flight == 0
+
+
+def test_waiting_for_a_slot_is_not_an_upstream_failure():
+    up = Upstream("t", timeout=0.15, max_concurrency=1, retries=0, failure_threshold=1)
+    fake = FakeUpstream(latency=0.1)
+
+    async def burst():
+        return await asyncio.gather(*(up.call(fake.acall, fallback=lambda: "busy") for _ in range(3)))
+
+    assert sorted(run(burst())) == ["busy", "ok", "ok"]
+    assert not up.is_open
+
+
+def test_busy_without_fallback_raises():
+    up = Upstream("t", timeout=0.05, max_concurrency=1, retries=0)
+    fake = FakeUpstream(latency=0.2)
+
+    async def burst():
+        return await asyncio.gather(up.call(fake.acall), up.call(fake.acall), return_exceptions=True)
+
+    results = run(burst())
+    assert any(isinstance(r, UpstreamBusyError) for r in results)
+
+
+def test_breaker_opens_and_short_circuits():
+    up = Upstream("t", timeout=1, max_concurrency=1, retries=0, failure_threshold=2, reset_after=60)
+    fake = FakeUpstream(fail_times=100)
+
+    for _ in range(2):
+        assert run(up.call(fake.acall, fallback=lambda: "fallback")) == "fallback"
+    assert up.is_open
+
+    assert run(up.call(fake.acall, fallback=lambda: "fallback")) == "fallback"
+    assert fake.calls == 2
+    with pytest.raises(CircuitOpenError):
+        run(up.call(fake.acall))
+
+
+def test_half_open_lets_one_trial_through():
+    up = Upstream("t", timeout=1, max_concurrency=4, retries=0, failure_threshold=1, reset_after=0.05)
+    fake = FakeUpstream(fail_times=1, latency=0.05)
+
+    run(up.call(fake.acall, fallback=lambda: None))
+    assert up.is_open
+    time.sleep(0.06)
+    assert not up.is_open
+
+    async def burst():
+        return await asyncio.gather(*(up.call(fake.acall, fallback=lambda: "skipped") for _ in range(4)))
+
+    assert sorted(run(burst())) == ["ok", "skipped", "skipped", "skipped"]
+    assert fake.calls == 2
+    assert up._opened_at is None
+
+
+def test_failed_trial_reopens():
+    up = Upstream("t", timeout=1, max_concurrency=1, retries=1, backoff=0.001, failure_threshold=1, reset_after=0.05)
+    fake = FakeUpstream(fail_times=100)
+
+    run(up.call(fake.acall, fallback=lambda: None))
+    time.sleep(0.06)
+    run(up.call(fake.acall, fallback=lambda: None))
+
+    # The trial failed, so its retry is short-circuited by the re-opened breaker.
+    assert up.is_open
+    assert fake.calls == 2
+
+
+@pytest.fixture
+def broken_llm(monkeypatch):
+    class DownLLM:
+        calls = 0
+
+        async def ainvoke(self, messages):
+            DownLLM.calls += 1
+            raise ConnectionError("llm down")
+
+    monkeypatch.setattr(server, "llm", DownLLM())
+    monkeypatch.setattr(server, "LLM", Upstream("llm", timeout=1, max_concurrency=1, retries=0))
+    return DownLLM
+
+
+def test_decide_falls_back_to_regex_intent(broken_llm):
+    state = run(server.decide_intent({"user_message": "Please add oat milk to my cart!"}))
+
+    assert (state["intent"], state["product"]) == ("add", "oat milk")
+    assert broken_llm.calls == 1
+
+
+def test_final_falls_back_to_tool_output(broken_llm):
+    state = run(server.final_response({"user_message": "add milk", "tool_output": "✅ Added Whole Milk"}))
+
+    assert state["final_message"] == "✅ Added Whole Milk"
+
+
+def test_small_talk_falls_back_to_canned_reply(broken_llm):
+    state = run(server.final_response({"user_message": "hello"}))
+
+    assert state["final_message"] == server.SMALL_TALK_FALLBACK
+
+
+def test_ingredient_search_serves_cache_when_down(monkeypatch):
+    calls = []
+
+    def run_search(query):
+        calls.append(query)
+        if len(calls) > 1:
+            raise ConnectionError("tavily down")
+        return [{"title": "Dough"}, {"title": "Basil"}]
+
+    monkeypatch.setattr(server.tavily, "run", run_search)
+    monkeypatch.setattr(server, "_ingredient_cache", {})
+    monkeypatch.setattr(server, "WEB_SEARCH", Upstream("tavily", timeout=1, max_concurrency=1, retries=0))
+
+    assert run(server.tavily_ingredient_search("Pizza")) == ["Dough", "Basil"]
+    assert run(server.tavily_ingredient_search("pizza")) == ["Dough", "Basil"]
+    assert run(server.tavily_ingredient_search("lasagna")) == []
+    assert len(calls) == 3
+
+
+def test_cancelled_trial_does_not_wedge_breaker():
+    up = Upstream("t", timeout=5, max_concurrency=1, retries=0, failure_threshold=1, reset_after=0.05)
+    fake = FakeUpstream(fail_times=1, latency=1.0)
+
+    run(up.call(fake.acall, fallback=lambda: None))
+    time.sleep(0.06)
+
+    async def cancel_trial():
+        trial = asyncio.create_task(up.call(fake.acall, fallback=lambda: None))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    run(cancel_trial())
+    assert not up.is_open
+
+    fake.latency = 0
+    assert run(up.call(fake.acall, fallback=lambda: "fallback")) == "ok"
+    assert up._opened_at is None
+
+
+def test_slots_work_across_event_loops():
+    up = Upstream("t", timeout=1, max_concurrency=1, retries=0)
+    fake = FakeUpstream(latency=0.02)
+
+    async def burst():
+        return await asyncio.gather(*(up.call(fake.acall) for _ in range(3)))
+
+    # Each lifespan (or asyncio.run) has its own loop; contention must not
+    # trip "bound to a different event loop".
+    assert run(burst()) == ["ok"] * 3
+    assert run(burst()) == ["ok"] * 3
+    assert fake.peak == 1
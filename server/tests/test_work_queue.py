@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+import server
+from conftest import FakeLLM
+
+
+class StalledLLM(FakeLLM):
+    """Answers the queued prompts, then never finishes another one."""
+
+    async def ainvoke(self, messages):
+        if not self.replies:
+            self.calls.append(messages)
+            await asyncio.Event().wait()
+        return await super().ainvoke(messages)
+
+
+def test_reply_cancelled_on_shutdown_is_marked_failed(monkeypatch):
+    monkeypatch.setenv("WORK_QUEUE_DRAIN_S", "0.05")
+    llm = StalledLLM("NONE")
+    monkeypatch.setattr(server, "llm", llm)
+
+    with TestClient(server.app) as client:
+        message_id = client.post("/agent?defer=true", json={"message": "hello"}).json()["message_id"]
+        while len(llm.calls) < 2:  # the reply is now stuck in the final call
+            time.sleep(0.01)
+        assert client.get(f"/agent/messages/{message_id}").json()["status"] == "pending"
+
+    assert server.deferred_messages[message_id] == {"status": "failed"}
+
+
+def test_deferred_reply_is_fetched_once_done(client, fake_llm):
+    fake_llm("NONE", "Hi there")
+
+    response = client.post("/agent?defer=true", json={"message": "hello"}).json()
+    deadline = time.monotonic() + 5
+    while True:
+        message = client.get(f"/agent/messages/{response['message_id']}").json()
+        if message["status"] != "pending" or time.monotonic() > deadline:
+            break
+        time.sleep(0.02)
+
+    assert message["status"] == "done"
+    assert message["final_message"] == "Hi there"
+    assert message["usage"]["llm_calls"] == 2  # intent call + reply call
+
+
+def test_unknown_message_is_not_found(client):
+    assert client.get("/agent/messages/nope").status_code == 404
+
+
+def test_full_queue_runs_job_inline(monkeypatch):
+    queue = server.WorkQueue(workers=1, maxsize=1)
+    monkeypatch.setattr(server, "work_queue", queue)
+    ran = []
+
+    async def scenario():
+        queue.start()
+        gate = asyncio.Event()
+        queue.submit("busy", gate.wait)
+        await asyncio.sleep(0)
+        assert queue.submit("fill", gate.wait)
+
+        inline = server.run_in_background("job", lambda: ran.append("inline"))
+        assert inline is not None and ran == []
+        await inline
+        gate.set()
+        await queue.shutdown(1)
+
+    asyncio.run(scenario())
+    assert ran == ["inline"]
+
+
+def test_shutdown_drains_quick_jobs():
+    queue = server.WorkQueue(workers=2, maxsize=10)
+    done = []
+
+    async def job(n):
+        await asyncio.sleep(0.01)
+        done.append(n)
+
+    async def scenario():
+        queue.start()
+        for n in range(5):
+            assert queue.submit(f"job-{n}", lambda n=n: job(n))
+        await queue.shutdown(1)
+
+    asyncio.run(scenario())
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    assert not queue.running
+
+
+def test_shutdown_cancels_slow_jobs_and_drops_the_rest():
+    queue = server.WorkQueue(workers=1, maxsize=10)
+    cancelled, dropped = [], []
+
+    async def slow():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    async def scenario():
+        queue.start()
+        queue.submit("slow", slow)
+        queue.submit("waiting", slow, on_drop=lambda: dropped.append("waiting"))
+        await asyncio.sleep(0)
+        await queue.shutdown(0.05)
+
+    asyncio.run(scenario())
+    assert cancelled == ["slow"]
+    assert dropped == ["waiting"]
+
+
+def test_queue_restarts_on_a_new_loop():
+    queue = server.WorkQueue(workers=1, maxsize=10)
+    done = []
+
+    async def run_once(n):
+        queue.start()
+        queue.submit("job", lambda: done.append(n))
+        await queue.shutdown(1)
+
+    asyncio.run(run_once(1))
+    asyncio.run(run_once(2))
+    assert done == [1, 2]